@@ -0,0 +1,262 @@
+"""Rules engine that drives the dust collector from SPS30 air quality samples.
+
+Every flattened sensor metric (e.g. "mass_density.pm2.5") can be tracked
+with a rolling statistic over a time window. Rules compare one of these
+statistics against a threshold and switch an action on or off with
+hysteresis and a minimum on-time. All statistics are updated
+incrementally, so evaluating a sample is O(1) (amortized) per rule.
+"""
+from collections import deque
+import json
+import math
+
+
+class WindowedMean:
+    """Mean of the samples seen in the last `window` seconds."""
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+        self.startTime = None
+
+    def add(self, t, value):
+        if not self.samples or self.samples[-1][0] <= t - self.window:
+            # First sample, or the window emptied out during a gap in reads
+            self.startTime = t
+        self.samples.append((t, value))
+        self.total += value
+        while self.samples[0][0] <= t - self.window:
+            (_, old) = self.samples.popleft()
+            self.total -= old
+
+    def ready(self, t):
+        """Whether the samples cover the whole window."""
+        return self.startTime is not None and t - self.startTime >= self.window
+
+    def value(self):
+        return self.total / len(self.samples) if self.samples else None
+
+
+class WindowedMax:
+    """Max of the samples seen in the last `window` seconds.
+
+    Uses a monotonically decreasing deque, so every sample is pushed and
+    popped at most once."""
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, t, value):
+        while self.samples and self.samples[-1][1] <= value:
+            self.samples.pop()
+        self.samples.append((t, value))
+        while self.samples[0][0] <= t - self.window:
+            self.samples.popleft()
+
+    def ready(self, t):
+        # The max of part of the window is still a lower bound of the max
+        return True
+
+    def value(self):
+        return self.samples[0][1] if self.samples else None
+
+
+class Ema:
+    """Exponential moving average with a time constant of `window` seconds.
+
+    The smoothing factor is derived from the time since the previous
+    sample, so irregular sample intervals are handled correctly."""
+    def __init__(self, window):
+        self.window = window
+        self.lastTime = None
+        self.startTime = None
+        self.ema = None
+
+    def add(self, t, value):
+        if self.ema is None or t - self.lastTime > self.window:
+            # Start over after a gap in reads longer than the time constant
+            self.ema = value
+            self.startTime = t
+        else:
+            alpha = 1.0 - math.exp(-max(t - self.lastTime, 0) / self.window)
+            self.ema += alpha * (value - self.ema)
+        self.lastTime = t
+
+    def ready(self, t):
+        """Whether the average has seen a full time constant of samples."""
+        return self.startTime is not None and t - self.startTime >= self.window
+
+    def value(self):
+        return self.ema
+
+
+class Last:
+    """Most recent sample; `window` is ignored."""
+    def __init__(self, window):
+        self.last = None
+
+    def add(self, t, value):
+        self.last = value
+
+    def ready(self, t):
+        return True
+
+    def value(self):
+        return self.last
+
+
+STAT_CLASSES = {
+    'mean': WindowedMean,
+    'max': WindowedMax,
+    'ema': Ema,
+    'last': Last,
+}
+
+
+class Rule:
+    """A threshold rule with hysteresis and a minimum on-time.
+
+    The rule becomes active when the statistic rises above `onAbove` and
+    becomes inactive once it falls below `offBelow`, but never before it
+    has been active for `minOn` seconds."""
+    def __init__(self, name, metric, stat, window, onAbove, offBelow, action, minOn):
+        if stat not in STAT_CLASSES:
+            raise ValueError(f"Rule {name}: unknown stat '{stat}'")
+        if offBelow > onAbove:
+            raise ValueError(f"Rule {name}: off_below must not exceed on_above")
+        if window <= 0:
+            raise ValueError(f"Rule {name}: window must be positive")
+        if minOn < 0:
+            raise ValueError(f"Rule {name}: min_on must not be negative")
+        self.name = name
+        self.metric = metric
+        self.stat = stat
+        self.window = window
+        self.onAbove = onAbove
+        self.offBelow = offBelow
+        self.action = action
+        self.minOn = minOn
+
+        self.active = False
+        self.activatedAt = None
+
+    def evaluate(self, t, value):
+        """Updates the active state from the latest statistic value."""
+        if value is None:
+            return self.active
+        if not self.active:
+            if value > self.onAbove:
+                self.active = True
+                self.activatedAt = t
+        elif value < self.offBelow and t - self.activatedAt >= self.minOn:
+            self.active = False
+            self.activatedAt = None
+        return self.active
+
+
+class RulesEngine:
+    """Evaluates rules against each new sample and switches actions.
+
+    `actions` maps an action name to an (on, off) pair of callables. An
+    action is switched on when any of its rules become active and switched
+    off once all of them are inactive. `on` may return False to decline, in
+    which case the action stays disengaged and is tried again with the next
+    sample. `off` may be None for actions that have nothing to undo (e.g.
+    opening the manual gate).
+
+    Mean and EMA rules are not evaluated until their statistic covers the
+    whole window, so a single reading after startup cannot trigger them."""
+    def __init__(self, rules, actions, onChange=None):
+        for rule in rules:
+            if rule.action not in actions:
+                raise ValueError(f"Rule {rule.name}: unknown action '{rule.action}'")
+        self.rules = rules
+        self.actions = actions
+        self.onChange = onChange
+        self.engaged = {action: False for action in actions}
+
+        # Rules sharing a (metric, stat, window) share a single tracker.
+        self.trackers = {}
+        self.trackersForMetric = {}
+        for rule in rules:
+            key = (rule.metric, rule.stat, rule.window)
+            if key not in self.trackers:
+                tracker = STAT_CLASSES[rule.stat](rule.window)
+                self.trackers[key] = tracker
+                self.trackersForMetric.setdefault(rule.metric, []).append(tracker)
+
+    def update(self, t, flatData):
+        """Feeds one flattened sample taken at unix time `t`.
+
+        Returns the list of (action, engaged) transitions that were made."""
+        for (metric, trackers) in self.trackersForMetric.items():
+            value = flatData.get(metric)
+            if value is None:
+                continue
+            for tracker in trackers:
+                tracker.add(t, value)
+
+        wanted = {action: False for action in self.actions}
+        for rule in self.rules:
+            tracker = self.trackers[(rule.metric, rule.stat, rule.window)]
+            value = tracker.value() if tracker.ready(t) else None
+            if rule.evaluate(t, value):
+                wanted[rule.action] = True
+
+        changes = []
+        for (action, want) in wanted.items():
+            if want == self.engaged[action]:
+                continue
+            (on, off) = self.actions[action]
+            if want:
+                if on() is False:
+                    continue
+            elif off is not None:
+                off()
+            self.engaged[action] = want
+            changes.append((action, want))
+            if self.onChange is not None:
+                self.onChange(action, want, [r.name for r in self.rules
+                                             if r.action == action and r.active])
+        return changes
+
+    def snapshot(self):
+        """Returns the current value of every tracked statistic and rule."""
+        return {
+            'rules': [{
+                'name': rule.name,
+                'metric': rule.metric,
+                'stat': rule.stat,
+                'window': rule.window,
+                'value': self.trackers[(rule.metric, rule.stat, rule.window)].value(),
+                'active': rule.active,
+            } for rule in self.rules],
+            'actions': dict(self.engaged),
+        }
+
+
+def load_rules(path):
+    """Loads rules from a JSON config file.
+
+    The file holds {"rules": [...]} where each rule has the keys name,
+    metric, stat, window (seconds), on_above, off_below, action and
+    optionally min_on (seconds). A missing file means no rules."""
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return []
+
+    rules = []
+    for entry in config.get('rules', []):
+        rules.append(Rule(
+            name=entry['name'],
+            metric=entry['metric'],
+            stat=entry.get('stat', 'mean'),
+            window=float(entry.get('window', 60)),
+            onAbove=float(entry['on_above']),
+            offBelow=float(entry.get('off_below', entry['on_above'])),
+            action=entry['action'],
+            minOn=float(entry.get('min_on', 0)),
+        ))
+    return rules
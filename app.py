@@ -15,6 +15,9 @@ import re
 
 # Setup logging
 import logging
+import logging.handlers
+import queue
+import atexit
 
 # Create a custom logger for app.py
 logger = logging.getLogger('app.py')
@@ -28,8 +31,13 @@ handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 
-# Add handler to logger
-logger.addHandler(handler)
+# Log records are put on a queue and written by a background thread, so the
+# MQTT and switch threads never block on stderr/journald.
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # Disable excessive logging from Flask and Werkzeug
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
@@ -38,6 +46,10 @@ def logMsg(message, level=logging.INFO):
     """Centralized logging function for consistent log formatting"""
     logger.log(level, message)
 
+# Recent gate, tool and dust collector events, served from /events
+from event_log import EventLog
+event_log = EventLog()
+
 # Setup influxdb client for data storage
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
@@ -68,6 +80,10 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(script_dir, 'sps30'))
 from sps30 import SPS30
 
+from air_quality_rules import RulesEngine, load_rules
+from sensor_stats import SensorStats
+from gate_latency import GateLatencyTracker
+
 pm_sensor = SPS30()
 logMsg(f"Firmware version: {pm_sensor.firmware_version()}")
 logMsg(f"Product type: {pm_sensor.product_type()}")
@@ -79,6 +95,12 @@ pm_sensor.start_measurement()
 
 app = Flask(__name__, static_folder="static")
 
+# Serve static/ pre-compressed, with content-hashed names for the scripts and
+# stylesheets so that the tablets can cache them for good.
+from assets import StaticAssets
+static_assets = StaticAssets(app.static_folder)
+app.view_functions['static'] = static_assets.serve
+
 scheduler = APScheduler()
 scheduler.api_enabled = True
 scheduler.init_app(app)
@@ -97,6 +119,14 @@ GATES_FOR_TOOLS = {
 }
 GATE_FOR_MANUAL = '10'
 PAT_GATE = re.compile(r'^[0-9]+$')
+# How many times gates which miss their switch deadline are re-commanded
+MAX_SWITCH_RETRIES = 2
+
+# Air quality rules which drive the dust collector from the SPS30 readings
+RULES_FILE = os.path.join(script_dir, 'air_quality_rules.json')
+
+# Set GARAGE_SERVER_PROFILER=1 to expose the sampling profiler at /debug/profile
+ENABLE_PROFILER = os.environ.get('GARAGE_SERVER_PROFILER') == '1'
 
 class Status:
     def __init__(self, id):
@@ -105,6 +135,7 @@ class Status:
         self.lastTickTime = datetime.min
         self.status = '?'
         self.json = None
+        self.latency = None
 
 class MqttClient:
     def __init__(self):
@@ -115,12 +146,24 @@ class MqttClient:
         self.pendingFuture = None
 
         self.idToStatusMap = {}
+        self.gateLatency = GateLatencyTracker()
 
         # History for sensor data using Pandas DataFrame
         self.sensor_history_df = pd.DataFrame()
         self.last_measurement = None
         self.MAX_HISTORY_RECORDS = 3600 # 1 hour at 1 second intervals (60*60)
 
+        self.rulesEngine = RulesEngine(
+            load_rules(RULES_FILE),
+            {
+                'dust_collector': (self.turnOnDustCollector, self.releaseDustCollector),
+                'manual_gate': (self.openManualGateForRules, None),
+            },
+            onChange=self.onRuleChange)
+
+        # Sliding-window statistics (1m to 24h) for every sensor metric
+        self.sensorStats = SensorStats()
+
         self.client.connect("127.0.0.1", 1883, 60)
         self.client.loop_start()
 
@@ -156,14 +199,19 @@ class MqttClient:
 
         status.json = msgJson
         if self.isGate(gateid):
+            if status.status != msgJson['gatePos']:
+                event_log.record('gate', gateid, 'pos', value=msgJson['gatePos'])
             status.status = msgJson['gatePos']
+            self.gateLatency.onPosition(gateid, status.status, time.monotonic())
             
     def updateStatuses(self):
         # print("Updating gate status")
         now = datetime.now()
-        for (_, status) in self.idToStatusMap.items():
+        for (id, status) in self.idToStatusMap.items():
             if now - status.lastTickTime > GATE_MAX_KEEPALIVE:
                 status.alive = False
+            if self.isGate(id):
+                status.latency = self.gateLatency.summary(id, time.monotonic())
 
     def onStatusUpdate(self, msg) -> Status:
         id = msg.topic.rsplit("/", 1)[1]
@@ -199,37 +247,93 @@ class MqttClient:
 
     def turnOnDustCollector(self):
         logMsg("Turning on dust collector")
+        event_log.record('dc', 'dc', 'on')
         GPIO.output(DC_ON_PIN, GPIO.HIGH)
         time.sleep(0.7)
         GPIO.output(DC_ON_PIN, GPIO.LOW)
 
     def turnOffDustCollector(self):
         logMsg("Turning off dust collector")
+        event_log.record('dc', 'dc', 'off')
         GPIO.output(DC_OFF_PIN, GPIO.HIGH)
         time.sleep(0.7)
         GPIO.output(DC_OFF_PIN, GPIO.LOW)
 
+    def isAnyToolOn(self):
+        return any(status.alive and status.status == "on"
+                   for (id, status) in self.idToStatusMap.items()
+                   if id in GATES_FOR_TOOLS)
+
+    def releaseDustCollector(self):
+        # A tool which is still running needs the dust collector even though
+        # the air has cleared up.
+        if self.isAnyToolOn():
+            logMsg("Air quality rules released but a tool is still on, keeping DC on")
+            return
+        self.turnOffDustCollector()
+
+    def openManualGateForRules(self):
+        # Opening the manual gate closes all the others, which would take the
+        # suction away from a tool which is running right now.
+        # Returning False leaves the action disengaged so that the rules try
+        # again once the tool is off.
+        if self.isAnyToolOn():
+            logMsg("Air quality rules want the manual gate but a tool is on, leaving gates alone",
+                   level=logging.DEBUG)
+            return False
+        self.openManualGate()
+
+    def onRuleChange(self, action, engaged, rules):
+        event_log.record('rule', action, 'engaged' if engaged else 'released', rules=rules)
+        if engaged:
+            logMsg(f"Air quality rules {rules} engaged {action}")
+        else:
+            logMsg(f"Air quality rules released {action}")
+
     def switchToTool(self, toolid):
         gateids = GATES_FOR_TOOLS[toolid]
+        targets = {}
         for (gateid, gate) in self.idToStatusMap.items():
-            gate = self.idToStatusMap[gateid]
             if not gate.alive or not self.isGate(gateid):
                 continue
-
-            if gateid in gateids:
-                self.gatecmd(gateid, "open")
-            else:
-                self.gatecmd(gateid, "close")
-
-        # Horrible busy loop kind of way of doing it. Unfortunately, it looks 
-        # like incorporating async/await with paho-mqtt is a very non-trivial 
-        # undertaking :( 
-        n = 0
-        while not self.isSwitchedToTool(toolid):
-            time.sleep(0.1)
-            n += 1
-            if n > 20:
+            targets[gateid] = "open" if gateid in gateids else "close"
+
+        for (gateid, cmd) in targets.items():
+            self.gatecmd(gateid, cmd)
+
+        for attempt in range(MAX_SWITCH_RETRIES + 1):
+            # Wait as long as the slowest gate involved usually takes, based
+            # on its observed latencies.
+            now = time.monotonic()
+            timeout = max((self.gateLatency.deadline(g, now) for g in targets), default=0)
+            deadline = now + timeout
+
+            # Horrible busy loop kind of way of doing it. Unfortunately, it looks 
+            # like incorporating async/await with paho-mqtt is a very non-trivial 
+            # undertaking :( 
+            while not self.isSwitchedToTool(toolid) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if self.isSwitchedToTool(toolid):
+                break
+
+            lagging = [g for (g, cmd) in targets.items()
+                       if self.idToStatusMap[g].status != cmd]
+            for gateid in lagging:
+                self.gateLatency.onTimeout(gateid, time.monotonic())
+            if attempt < MAX_SWITCH_RETRIES:
+                logMsg(f"Gates {lagging} missed their {timeout:.1f}s deadline, retrying",
+                       level=logging.WARNING)
+                for gateid in lagging:
+                    self.gatecmd(gateid, targets[gateid])
+        else:
+            # A gate which failed to close only costs some suction, but with
+            # one of the tool's gates still shut the DC would do no good.
+            if any(self.idToStatusMap[g].status != "open" for g in gateids if g in targets):
+                logMsg(f"Could not open the gates for {toolid}, not turning on DC",
+                       level=logging.WARNING)
                 return
+            logMsg(f"Gates {lagging} failed to close, turning on DC anyway",
+                   level=logging.WARNING)
 
         logMsg("Telling coordinator to turn on DC")
         time.sleep(0.2)
@@ -248,6 +352,7 @@ class MqttClient:
         logMsg("Getting tool sensor message")
         status = self.onStatusUpdate(msg)
         logMsg(f"Tool {status.id} was switched {status.status}")
+        event_log.record('tool', status.id, status.status)
         if status.status == "on":
             record = (Point("tool_status")
                 .field("current_tool", status.id)
@@ -265,6 +370,9 @@ class MqttClient:
                 .time(datetime.utcnow(), WritePrecision.NS))
             write_api.write(bucket=TOOL_SENSOR_BUCKET, 
                             record=record)
+            if self.rulesEngine.engaged.get('dust_collector'):
+                logMsg("Air quality rules are active, keeping DC on")
+                return
             logMsg("Telling coordinator to turn off DC")
             self.turnOffDustCollector()
             
@@ -277,6 +385,8 @@ class MqttClient:
             logMsg("Processing gate acknowledgement")
             status = self.onStatusUpdate(msg)
             logMsg(f"Gate {status.id} is {status.status}")
+            event_log.record('gate', status.id, 'ack', value=status.status)
+            self.gateLatency.onAck(status.id, status.status, time.monotonic())
         elif msg.topic.startswith("/coordinator_keypress"):
             self.onCoordinatorKeyPress(msg)
 
@@ -309,6 +419,14 @@ class MqttClient:
             logMsg("No metrics extracted from sensor data.")
             return # Exit if no data extracted
 
+        # Evaluate air quality rules before the slower InfluxDB write. A
+        # failing rule or action must not cost us the sample itself.
+        try:
+            self.rulesEngine.update(timestamp_unix, flat_data)
+        except Exception as e:
+            logMsg(f"Air quality rules failed: {e!r}", level=logging.ERROR)
+        self.sensorStats.add(timestamp_unix, flat_data)
+
         # Write to InfluxDB
         point = Point("sensor_data").tag("sensor", "sps30").time(datetime.utcnow(), WritePrecision.NS)
         for key, value in flat_data.items():
@@ -331,6 +449,10 @@ class MqttClient:
 
     def gatecmd(self, gateid, gatecmd):
         logMsg(f"Publishing message /gatecmd/{gateid} {gatecmd}")
+        event_log.record('gate', gateid, 'cmd', value=gatecmd)
+        status = self.idToStatusMap.get(gateid)
+        self.gateLatency.onCommand(gateid, gatecmd, time.monotonic(),
+                                   status.status if status else None)
         self.client.publish("/gatecmd/" + gateid, gatecmd)
 
 mqtt_client = MqttClient()
@@ -364,6 +486,11 @@ def gate_status():
 def sps30():
     return mqtt_client.last_measurement
 
+@app.route("/air_quality_rules")
+def air_quality_rules():
+    """Returns the current value and state of every air quality rule."""
+    return mqtt_client.rulesEngine.snapshot()
+
 @app.route("/gatecmd/<gateid>/<gatecmd>")
 def gatecmd(gateid, gatecmd):
     mqtt_client.gatecmd(gateid, gatecmd)
@@ -387,6 +514,36 @@ def dust_collector(action):
         return "Invalid action", 400
     return "ok"
 
+@app.route("/sensor_stats")
+def sensor_stats():
+    """Returns count, mean, min, max and p50/p95/p99 for every metric over
+    the 1m, 10m, 1h and 24h sliding windows.
+
+    Optional `metric` and `window` query arguments (repeatable) restrict the
+    response, e.g. /sensor_stats?metric=mass_density.pm2.5&window=10m"""
+    metrics = request.args.getlist('metric') or None
+    windows = request.args.getlist('window') or None
+    return mqtt_client.sensorStats.summary(time.time(), metrics, windows)
+
+@app.route("/events")
+def events():
+    """Returns recent gate, tool, dust collector and rule events.
+
+    `since` is the last sequence number the client has seen (the `last` field
+    of the previous response). `type` and `id` (repeatable) filter the
+    events and `limit` caps how many of the oldest matches after `since` are
+    returned. `missed` is true when some events after `since` have already
+    been dropped from the ring, or when `since` is from before a server
+    restart (the events are then returned from the start of the ring)."""
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None and limit < 1:
+        return "limit must be positive", 400
+    types = request.args.getlist('type') or None
+    ids = request.args.getlist('id') or None
+    (matched, last, missed) = event_log.query(since, types, ids, limit)
+    return {'events': matched, 'last': last, 'missed': missed}
+
 # Route to handle blah.html and redirect to port 5000
 @app.route('/sensor_history_grafana')
 def redirect_to_blah():
@@ -407,5 +564,34 @@ def sensor_history():
     json_data = mqtt_client.sensor_history_df.reset_index().rename(columns={'index': 'timestamp'}).to_json(orient='records', date_format='iso')
     return Response(json_data, mimetype='application/json')
 
+if ENABLE_PROFILER:
+    import profiler
+
+    @app.route("/debug/profile")
+    def debug_profile():
+        """Samples the stacks of all threads for `seconds` (default 10) at
+        `rate` samples per second (default 100).
+
+        Returns the number of ticks actually taken and the achieved rate,
+        per-thread sample counts and the `top` (default 20) functions as JSON, or with format=collapsed the collapsed stacks for flame
+        graphs."""
+        seconds = min(request.args.get('seconds', 10, type=float), profiler.MAX_SECONDS)
+        rate = min(request.args.get('rate', 100, type=float), profiler.MAX_RATE)
+        top = request.args.get('top', 20, type=int)
+        if seconds <= 0 or rate <= 0:
+            return "seconds and rate must be positive", 400
+
+        if not profiler.profile_lock.acquire(blocking=False):
+            return "A profile is already running", 409
+        try:
+            (stacks, ticks, elapsed) = profiler.sample(seconds, rate)
+        finally:
+            profiler.profile_lock.release()
+
+        if request.args.get('format') == 'collapsed':
+            return Response(profiler.collapsed(stacks), mimetype='text/plain')
+        return {'seconds': elapsed, 'requested_rate': rate, 'rate': ticks / elapsed,
+                'ticks': ticks, **profiler.summary(stacks, top)}
+
 if __name__ == '__main__':
     app.run(debug=False)
@@ -0,0 +1,198 @@
+"""Pre-compressed, fingerprinted delivery of the files in static/.
+
+At startup every static file is read into memory, compressed with gzip (and
+brotli when the `brotli` package is installed) and given a content-hashed
+name such as dashboard.1a2b3c4d5e.mjs. Hashed names are served with
+immutable long-lived cache headers. HTML pages keep their plain names and
+are served with `no-cache`, but are rewritten to reference the hashed
+scripts and stylesheets, to carry an import map which redirects the
+relative ES module imports to the hashed modules, and to preload the
+whole module graph so it is fetched in parallel instead of one import at a
+time. Stylesheets are rewritten to @import the hashed names of other
+stylesheets, and pages preload those imports too.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import Response, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+PAT_LOCAL_REF = re.compile(r'(src|href)="([^"/:?#]+\.(?:mjs|js|css))"')
+PAT_MODULE_IMPORT = re.compile(r'''(?:import|from)\s*['"]\./([^'"]+\.mjs)['"]''')
+# @import url('x.css'), @import "x.css" and url(x.png) with a local name
+PAT_CSS_REF = re.compile(r'''(@import\s+['"]|url\(\s*['"]?)([^'"()\s/:?#]+)(['"]?\s*\)|['"])''')
+PAT_HEAD = re.compile(r'<head[^>]*>')
+
+
+class Asset:
+    def __init__(self, body, mimetype, cacheControl):
+        self.body = body
+        self.mimetype = mimetype
+        self.cacheControl = cacheControl
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+
+        # Encoding -> body, only kept when smaller than the original
+        self.encoded = {}
+        compressed = gzip.compress(body, compresslevel=9)
+        if len(compressed) < len(body):
+            self.encoded['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body)
+            if len(compressed) < len(body):
+                self.encoded['br'] = compressed
+
+
+class StaticAssets:
+    def __init__(self, staticDir, urlPrefix='/static/'):
+        self.staticDir = staticDir
+        self.urlPrefix = urlPrefix
+        self.assets = {}
+        self.hashedNames = {}
+        # Stylesheet -> the local stylesheets it @imports
+        self.cssImports = {}
+        self.build()
+
+    def build(self):
+        sources = {}
+        for name in sorted(os.listdir(self.staticDir)):
+            path = os.path.join(self.staticDir, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    sources[name] = f.read()
+
+        for name in sources:
+            if not name.endswith('.html'):
+                self.hashAsset(name, sources, set())
+
+        # Pages are rewritten once all the hashed names are known
+        for (name, body) in sources.items():
+            if name.endswith('.html'):
+                html = self.rewriteHtml(body.decode('utf-8'), sources)
+                self.assets[name] = Asset(html.encode('utf-8'), 'text/html', REVALIDATE)
+
+    def hashAsset(self, name, sources, visiting):
+        """Adds the plain and hashed asset for name and returns the hashed name.
+
+        Stylesheets are rewritten to reference the hashed names of what they
+        @import or url() before being hashed themselves, so that an immutable
+        stylesheet never pulls in a file which needs revalidating."""
+        if name in self.hashedNames:
+            return self.hashedNames[name]
+        body = sources[name]
+        if name.endswith('.css'):
+            visiting.add(name)
+            self.cssImports[name] = []
+
+            def hashedRef(m):
+                ref = m.group(2)
+                if ref not in sources or ref in visiting or ref.endswith('.html'):
+                    return m.group(0)
+                if ref.endswith('.css'):
+                    self.cssImports[name].append(ref)
+                return m.group(1) + self.hashAsset(ref, sources, visiting) + m.group(3)
+
+            body = PAT_CSS_REF.sub(hashedRef, body.decode('utf-8')).encode('utf-8')
+            visiting.discard(name)
+
+        (stem, ext) = os.path.splitext(name)
+        digest = hashlib.sha256(body).hexdigest()[:10]
+        hashedName = f"{stem}.{digest}{ext}"
+        self.hashedNames[name] = hashedName
+        self.assets[name] = Asset(body, self.mimetype(name), REVALIDATE)
+        self.assets[hashedName] = Asset(body, self.mimetype(name), IMMUTABLE)
+        return hashedName
+
+    def mimetype(self, name):
+        if name.endswith('.mjs'):
+            return 'text/javascript'
+        return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    def moduleGraph(self, text, sources):
+        """Returns all local modules reachable through static imports in text."""
+        seen = []
+        todo = PAT_MODULE_IMPORT.findall(text)
+        while todo:
+            name = todo.pop()
+            if name in seen or name not in sources:
+                continue
+            seen.append(name)
+            todo.extend(PAT_MODULE_IMPORT.findall(sources[name].decode('utf-8')))
+        return seen
+
+    def cssImportGraph(self, stylesheets):
+        """Returns the stylesheets transitively @imported by stylesheets."""
+        seen = []
+        todo = [ref for name in stylesheets for ref in self.cssImports.get(name, [])]
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.append(name)
+            todo.extend(self.cssImports.get(name, []))
+        return seen
+
+    def url(self, name):
+        return self.urlPrefix + self.hashedNames.get(name, name)
+
+    def rewriteHtml(self, html, sources):
+        entries = [name for (attr, name) in PAT_LOCAL_REF.findall(html) if name.endswith('.mjs')]
+        modules = self.moduleGraph(html + ''.join(f"from './{e}'" for e in entries), sources)
+
+        importMap = {'imports': {self.urlPrefix + name: self.url(name)
+                                 for name in self.hashedNames if name.endswith('.mjs')}}
+        head = [f'\n    <script type="importmap">{json.dumps(importMap)}</script>']
+        head.extend(f'\n    <link rel="modulepreload" href="{self.url(name)}">' for name in modules)
+        # Fetch @imported stylesheets alongside the ones which import them
+        stylesheets = [name for (attr, name) in PAT_LOCAL_REF.findall(html) if name.endswith('.css')]
+        head.extend(f'\n    <link rel="preload" as="style" href="{self.url(name)}">'
+                    for name in self.cssImportGraph(stylesheets))
+
+        html = PAT_LOCAL_REF.sub(
+            lambda m: f'{m.group(1)}="{self.hashedNames.get(m.group(2), m.group(2))}"', html)
+        return PAT_HEAD.sub(lambda m: m.group(0) + ''.join(head), html, count=1)
+
+    def serve(self, filename):
+        """View function for the /static/<path:filename> route."""
+        asset = self.assets.get(filename)
+        if asset is None:
+            return send_from_directory(self.staticDir, filename)
+
+        encoding = self.chooseEncoding(asset)
+        etag = f'"{asset.etag}-{encoding}"'
+        headers = {
+            'Cache-Control': asset.cacheControl,
+            'ETag': etag,
+            'Vary': 'Accept-Encoding',
+        }
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers=headers)
+
+        if encoding == 'identity':
+            body = asset.body
+        else:
+            body = asset.encoded[encoding]
+            headers['Content-Encoding'] = encoding
+        return Response(body, mimetype=asset.mimetype, headers=headers)
+
+    def chooseEncoding(self, asset):
+        accepted = set()
+        for token in request.headers.get('Accept-Encoding', '').split(','):
+            (coding, _, params) = token.strip().partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(coding.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.encoded and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
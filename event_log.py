@@ -0,0 +1,56 @@
+"""Fixed-size in-memory ring of structured gate, tool and dust collector events."""
+from collections import deque
+import threading
+import time
+
+
+class EventLog:
+    """Keeps the last `maxEvents` events, each tagged with an increasing
+    sequence number so that clients can poll for what they have not seen."""
+    def __init__(self, maxEvents=2000):
+        self.events = deque(maxlen=maxEvents)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def record(self, type, id, event, **fields):
+        with self.lock:
+            self.seq += 1
+            self.events.append({
+                'seq': self.seq,
+                'time': time.time(),
+                'type': type,
+                'id': id,
+                'event': event,
+                **fields,
+            })
+
+    def query(self, since=0, types=None, ids=None, limit=None):
+        """Returns (events, lastSeq, missed) for events with seq > since,
+        optionally restricted to the given types and ids.
+
+        With a limit, only the oldest `limit` matching events are returned
+        and lastSeq is the seq of the last one, so polling again with
+        since=lastSeq picks up where this call stopped. `missed` is True when
+        events after `since` have already been dropped from the ring, or when
+        `since` is ahead of the log because the server has restarted."""
+        with self.lock:
+            lastSeq = self.seq
+            missed = since > self.seq or (
+                bool(self.events) and since < self.events[0]['seq'] - 1)
+            if since > self.seq:
+                # The client's position is from before a restart
+                since = 0
+            # Sequence numbers are contiguous, so index straight to since + 1
+            start = max(since - self.events[0]['seq'] + 1, 0) if self.events else 0
+            matched = []
+            for i in range(start, len(self.events)):
+                e = self.events[i]
+                if types is not None and e['type'] not in types:
+                    continue
+                if ids is not None and e['id'] not in ids:
+                    continue
+                matched.append(e)
+                if limit is not None and len(matched) >= limit:
+                    lastSeq = e['seq']
+                    break
+        return (matched, lastSeq, missed)
@@ -0,0 +1,179 @@
+"""Per-gate command latency tracking.
+
+Every /gatecmd publish which moves a gate is timestamped and matched against
+the next /gateack and heartbeat gatePos reporting the commanded position.
+The observed latencies give each gate its own switch deadline and flag
+gates that are getting slower (e.g. a failing servo).
+"""
+from collections import deque
+import statistics
+import threading
+
+from sensor_stats import QuantileSketch, WindowedStats
+
+DEFAULT_DEADLINE = 2.0  # seconds, used until a gate has enough recent history
+MIN_DEADLINE = 1.0
+MAX_DEADLINE = 10.0
+DEADLINE_QUANTILE = 0.95
+DEADLINE_MARGIN = 1.5
+DEADLINE_SLACK = 0.5  # seconds on top of the scaled quantile
+LATENCY_WINDOW = 60 * 60  # deadlines follow the last hour of commands
+MIN_SAMPLES = 5
+RECENT_COMMANDS = 20
+DEGRADED_FACTOR = 2.0
+DEGRADED_MISSES = 3
+
+
+class PendingCommand:
+    def __init__(self, cmd, sentAt):
+        self.cmd = cmd
+        self.sentAt = sentAt
+        self.acked = False
+        self.positioned = False
+        self.timedOut = False
+        # Time elapsed when the command last missed its deadline
+        self.lowerBound = None
+
+    def isConfirmed(self):
+        return self.acked or self.positioned
+
+
+class GateLatency:
+    """Latencies of a single gate.
+
+    Every command contributes at most one confirmation sample: the time until
+    it was first confirmed or, for a command which timed out and was never
+    confirmed, the time elapsed at its last timeout."""
+    def __init__(self):
+        self.pending = None
+        self.ack = WindowedStats(LATENCY_WINDOW)
+        self.position = WindowedStats(LATENCY_WINDOW)
+        # Time until the gate first confirmed the command, by ack or heartbeat
+        self.confirm = WindowedStats(LATENCY_WINDOW)
+        # All-time confirmations, the baseline for spotting a degrading gate
+        self.baseline = QuantileSketch()
+        self.recent = deque(maxlen=RECENT_COMMANDS)
+        self.recentMisses = deque(maxlen=RECENT_COMMANDS)
+        self.commands = 0
+        self.timeouts = 0
+
+    def confirmed(self, t):
+        self.addSample(t, t - self.pending.sentAt)
+        if not self.pending.timedOut:
+            self.recentMisses.append(False)
+
+    def addSample(self, t, latency):
+        self.confirm.add(t, latency)
+        self.baseline.add(latency)
+        self.recent.append(latency)
+
+    def deadline(self, now):
+        stats = self.confirm.summary(now)
+        if stats['count'] < MIN_SAMPLES:
+            return DEFAULT_DEADLINE
+        slowest = DEADLINE_MARGIN * stats[f"p{round(DEADLINE_QUANTILE * 100)}"] + DEADLINE_SLACK
+        return min(max(slowest, MIN_DEADLINE), MAX_DEADLINE)
+
+    def isDegraded(self):
+        if sum(self.recentMisses) >= DEGRADED_MISSES:
+            return True
+        if len(self.recent) < MIN_SAMPLES:
+            return False
+        return statistics.median(self.recent) > DEGRADED_FACTOR * self.baseline.quantile(0.5)
+
+
+class GateLatencyTracker:
+    """Called from the MQTT thread (acks, heartbeats) and from the switch and
+    Flask threads (commands, timeouts), hence the lock."""
+    def __init__(self):
+        self.gates = {}
+        self.lock = threading.Lock()
+
+    def gate(self, gateid):
+        gate = self.gates.get(gateid)
+        if gate is None:
+            gate = GateLatency()
+            self.gates[gateid] = gate
+        return gate
+
+    def onCommand(self, gateid, cmd, t, current):
+        """Records a command published at `t` to a gate whose last reported
+        position is `current`."""
+        with self.lock:
+            gate = self.gate(gateid)
+            gate.commands += 1
+            pending = gate.pending
+            if pending is not None and pending.timedOut and not pending.isConfirmed():
+                if pending.cmd == cmd:
+                    # A retry: keep timing from the original command, otherwise
+                    # a late ack would be timed from the retry.
+                    return
+                # Never confirmed, so all we know is it took at least this long
+                gate.addSample(t, pending.lowerBound)
+            if cmd == current:
+                # The gate is already there and will confirm right away,
+                # which says nothing about how long it takes to move.
+                gate.pending = None
+                return
+            gate.pending = PendingCommand(cmd, t)
+
+    def onAck(self, gateid, value, t):
+        with self.lock:
+            gate = self.gate(gateid)
+            pending = gate.pending
+            if pending is None or pending.acked or pending.cmd != value:
+                return
+            pending.acked = True
+            gate.ack.add(t, t - pending.sentAt)
+            if not pending.positioned:
+                gate.confirmed(t)
+
+    def onPosition(self, gateid, value, t):
+        with self.lock:
+            gate = self.gate(gateid)
+            pending = gate.pending
+            # Heartbeats received before the command went out report the
+            # old position, even if it happens to match.
+            if (pending is None or pending.positioned or pending.cmd != value
+                    or t <= pending.sentAt):
+                return
+            pending.positioned = True
+            gate.position.add(t, t - pending.sentAt)
+            if not pending.acked:
+                gate.confirmed(t)
+
+    def onTimeout(self, gateid, t):
+        """Records that the gate missed its switch deadline at `t`.
+
+        Retries of the same command count as a single miss. The time elapsed
+        is kept as a lower bound on the latency, which is recorded if the
+        command is never confirmed."""
+        with self.lock:
+            gate = self.gate(gateid)
+            pending = gate.pending
+            if pending is None or pending.isConfirmed():
+                return
+            if not pending.timedOut:
+                pending.timedOut = True
+                gate.timeouts += 1
+                gate.recentMisses.append(True)
+            pending.lowerBound = t - pending.sentAt
+
+    def deadline(self, gateid, now):
+        with self.lock:
+            return self.gate(gateid).deadline(now)
+
+    def summary(self, gateid, now):
+        """Returns counters, the current deadline and the latency statistics
+        of the last LATENCY_WINDOW seconds."""
+        with self.lock:
+            gate = self.gate(gateid)
+            return {
+                'commands': gate.commands,
+                'timeouts': gate.timeouts,
+                'deadline': gate.deadline(now),
+                'degraded': gate.isDegraded(),
+                'ack': gate.ack.summary(now),
+                'position': gate.position.summary(now),
+                'confirm': gate.confirm.summary(now),
+            }
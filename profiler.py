@@ -0,0 +1,88 @@
+"""Sampling profiler for the live server.
+
+Periodically snapshots the stack of every thread with sys._current_frames()
+and aggregates the samples per thread name. Nothing runs unless a profile
+has been requested.
+"""
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+MAX_SECONDS = 60
+MAX_RATE = 1000
+
+# Only one profile at a time; sampling from two requests would skew both
+profile_lock = threading.Lock()
+
+
+def frameLabel(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample(seconds, rate):
+    """Samples all other threads `rate` times a second for `seconds`.
+
+    Returns (stacks, ticks, elapsed) where stacks is a Counter of
+    (threadName, frames) -> samples, with frames ordered from the outermost
+    call to the innermost one, and ticks is how many snapshots were actually
+    taken in `elapsed` seconds. Ticks are scheduled against a deadline, so
+    the time spent taking a snapshot doesn't lower the rate, but a tick
+    which is late is not made up for with a burst."""
+    me = threading.get_ident()
+    interval = 1.0 / rate
+    stacks = Counter()
+    ticks = 0
+    start = time.monotonic()
+    end = start + seconds
+    nextTick = start
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        if now < nextTick:
+            time.sleep(nextTick - now)
+            continue
+        nextTick = max(nextTick + interval, now)
+        ticks += 1
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frameLabel(frame))
+                frame = frame.f_back
+            frames.reverse()
+            stacks[(names.get(ident, str(ident)), tuple(frames))] += 1
+    return (stacks, ticks, time.monotonic() - start)
+
+
+def collapsed(stacks):
+    """Formats samples in the collapsed-stack format used by flamegraph.pl
+    and speedscope, with the thread name as the root frame."""
+    lines = [';'.join((threadName,) + frames) + f" {count}"
+             for ((threadName, frames), count) in stacks.most_common()]
+    return '\n'.join(lines) + '\n'
+
+
+def summary(stacks, top=20):
+    """Returns samples per thread and the `top` functions by self and
+    inclusive (total) samples."""
+    threads = Counter()
+    selfCounts = Counter()
+    totalCounts = Counter()
+    for ((threadName, frames), count) in stacks.items():
+        threads[threadName] += count
+        if frames:
+            selfCounts[frames[-1]] += count
+        # Count recursive functions once per sample
+        for label in set(frames):
+            totalCounts[label] += count
+    return {
+        'threads': dict(threads.most_common()),
+        'top_self': [{'function': f, 'samples': n} for (f, n) in selfCounts.most_common(top)],
+        'top_total': [{'function': f, 'samples': n} for (f, n) in totalCounts.most_common(top)],
+    }
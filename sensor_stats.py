@@ -0,0 +1,178 @@
+"""Sliding-window statistics for the SPS30 metrics.
+
+Each window is split into a fixed number of time buckets. A bucket keeps
+count, sum, min, max and a mergeable quantile sketch of the samples that
+fell into it, and is reused once it slides out of the window. Answering a
+query merges a bounded number of buckets, so it costs the same whether the
+window holds a minute or a day of samples.
+"""
+import math
+import threading
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Window name -> length in seconds
+WINDOWS = {
+    '1m': 60,
+    '10m': 10 * 60,
+    '1h': 60 * 60,
+    '24h': 24 * 60 * 60,
+}
+
+
+class QuantileSketch:
+    """Log-bucketed quantile sketch with a bounded relative error.
+
+    Values are counted in buckets whose boundaries grow geometrically, so
+    every quantile is returned within `relativeAccuracy` of the true value
+    and two sketches are merged by adding their bucket counts (the same idea
+    as DDSketch)."""
+    def __init__(self, relativeAccuracy=0.01):
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def key(self, value):
+        return math.ceil(math.log(value) / self.logGamma)
+
+    def keyValue(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        if value > 0:
+            k = self.key(value)
+            self.positive[k] = self.positive.get(k, 0) + 1
+        elif value < 0:
+            k = self.key(-value)
+            self.negative[k] = self.negative.get(k, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def merge(self, other):
+        for (k, n) in other.positive.items():
+            self.positive[k] = self.positive.get(k, 0) + n
+        for (k, n) in other.negative.items():
+            self.negative[k] = self.negative.get(k, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for k in sorted(self.negative, reverse=True):
+            seen += self.negative[k]
+            if seen > rank:
+                return -self.keyValue(k)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for k in sorted(self.positive):
+            seen += self.positive[k]
+            if seen > rank:
+                return self.keyValue(k)
+        return self.keyValue(max(self.positive))
+
+
+class Bucket:
+    def __init__(self, relativeAccuracy):
+        self.relativeAccuracy = relativeAccuracy
+        self.reset(None)
+
+    def reset(self, epoch):
+        self.epoch = epoch
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(self.relativeAccuracy)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sketch.add(value)
+
+
+class WindowedStats:
+    """Statistics over the last `window` seconds, kept in `numBuckets` buckets.
+
+    The window advances one bucket at a time, so it covers between
+    (numBuckets - 1) and numBuckets bucket widths of samples."""
+    def __init__(self, window, numBuckets=60, relativeAccuracy=0.01):
+        self.width = window / numBuckets
+        self.buckets = [Bucket(relativeAccuracy) for _ in range(numBuckets)]
+        self.relativeAccuracy = relativeAccuracy
+
+    def add(self, t, value):
+        epoch = int(t // self.width)
+        bucket = self.buckets[epoch % len(self.buckets)]
+        if bucket.epoch != epoch:
+            bucket.reset(epoch)
+        bucket.add(value)
+
+    def summary(self, now):
+        oldest = int(now // self.width) - len(self.buckets)
+        count = 0
+        total = 0.0
+        lo = math.inf
+        hi = -math.inf
+        sketch = QuantileSketch(self.relativeAccuracy)
+        for bucket in self.buckets:
+            if bucket.epoch is None or bucket.epoch <= oldest or bucket.count == 0:
+                continue
+            count += bucket.count
+            total += bucket.total
+            lo = min(lo, bucket.min)
+            hi = max(hi, bucket.max)
+            sketch.merge(bucket.sketch)
+
+        if count == 0:
+            return {'count': 0, 'mean': None, 'min': None, 'max': None,
+                    **{f"p{round(q * 100)}": None for q in QUANTILES}}
+        # The sketch returns bucket midpoints, which can fall just outside the
+        # range of the samples themselves
+        return {'count': count, 'mean': total / count, 'min': lo, 'max': hi,
+                **{f"p{round(q * 100)}": min(max(sketch.quantile(q), lo), hi)
+                   for q in QUANTILES}}
+
+
+class SensorStats:
+    """Per-metric sliding-window statistics for flattened sensor samples.
+
+    Samples are added from the scheduler thread and queried from Flask
+    request threads, hence the lock."""
+    def __init__(self, windows=WINDOWS):
+        self.windows = windows
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, t, flatData):
+        with self.lock:
+            for (metric, value) in flatData.items():
+                stats = self.metrics.get(metric)
+                if stats is None:
+                    stats = {name: WindowedStats(seconds)
+                             for (name, seconds) in self.windows.items()}
+                    self.metrics[metric] = stats
+                for windowStats in stats.values():
+                    windowStats.add(t, value)
+
+    def summary(self, now, metrics=None, windows=None):
+        """Returns {metric: {window: stats}}, optionally restricted to the
+        given metric and window names."""
+        with self.lock:
+            return {
+                metric: {name: windowStats.summary(now)
+                         for (name, windowStats) in stats.items()
+                         if windows is None or name in windows}
+                for (metric, stats) in self.metrics.items()
+                if metrics is None or metric in metrics
+            }